@@ -1,36 +1,81 @@
 import os
-import json
+import asyncio
+import logging
+import hashlib
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import List, Optional
+from string import Template
+from typing import Dict, List, Optional
+
+import msgspec
+from cachetools import TTLCache
 
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel, Field, field_validator
 from dotenv import load_dotenv
+from starlette.background import BackgroundTask
 
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
-from sqlalchemy.orm import sessionmaker, declarative_base, Session as DBSession
+from sqlalchemy import Column, Integer, String, Text, DateTime, select
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
 
 import google.generativeai as genai
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
 
 # ----------------- Config -----------------
 load_dotenv()
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-MYSQL_URL = os.getenv("MYSQL_URL", "sqlite:///./ai_travel.db")
-engine = create_engine(
-    MYSQL_URL,
-    echo=False,
-    connect_args={"check_same_thread": False} if "sqlite" in MYSQL_URL else {},
-)
+logger = logging.getLogger(__name__)
 
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+MYSQL_URL = os.getenv("MYSQL_URL", "sqlite+aiosqlite:///./ai_travel.db")
+REDIS_URL = os.getenv("REDIS_URL")
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", "3600"))
 
 if not GEMINI_API_KEY:
     raise RuntimeError("Please set GEMINI_API_KEY in .env")
 
 genai.configure(api_key=GEMINI_API_KEY)
 
-app = FastAPI(title="AI Travel Planner", version="2.0.0")
+GEMINI_MODEL_NAME = "gemini-2.0-flash-lite"
+GEMINI_MODEL = genai.GenerativeModel(GEMINI_MODEL_NAME)
+MAX_TOKENS = genai.protos.Candidate.FinishReason.MAX_TOKENS
+GEN_CONFIG = {
+    "temperature": 0.6,
+    "top_p": 0.9,
+    "max_output_tokens": 4096,
+    "response_mime_type": "application/json",
+}
+
+# Optional cache for /history/{id} responses
+redis_client = (
+    aioredis.from_url(REDIS_URL, socket_timeout=1, socket_connect_timeout=1)
+    if REDIS_URL
+    else None
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await init_db()
+    yield
+    await engine.dispose()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+app = FastAPI(
+    title="AI Travel Planner",
+    version="2.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -39,11 +84,42 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 # ----------------- DB Config -----------------
+# The engine is async; URLs written for the old sync drivers keep working
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+    "mysql": "mysql+aiomysql",
+    "mysql+pymysql": "mysql+aiomysql",
+    "mysql+mysqldb": "mysql+aiomysql",
+}
+
+
+def async_db_url(url: str) -> URL:
+    parsed = make_url(url)
+    driver = ASYNC_DRIVERS.get(parsed.drivername)
+    return parsed.set(drivername=driver) if driver else parsed
+
+
 Base = declarative_base()
-engine = create_engine(MYSQL_URL, echo=False, pool_pre_ping=True)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+# aiosqlite runs on a NullPool, so the queue pool settings only apply to MySQL
+POOL_OPTIONS = (
+    {}
+    if "sqlite" in MYSQL_URL
+    else {
+        "pool_size": 20,
+        "max_overflow": 30,
+        "pool_timeout": 30,
+        "pool_recycle": 1800,
+        "pool_use_lifo": True,
+    }
+)
+engine = create_async_engine(
+    async_db_url(MYSQL_URL), echo=False, pool_pre_ping=True, **POOL_OPTIONS
+)
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 
 
 class TravelRecord(Base):
@@ -56,18 +132,33 @@ class TravelRecord(Base):
     trip_length_days = Column(Integer)
     preferences = Column(Text)
     response = Column(Text)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
 
 
-Base.metadata.create_all(bind=engine)
+def create_tables(conn) -> None:
+    Base.metadata.create_all(conn)
+    # create_all skips tables that already exist, so add indexes introduced since
+    for index in TravelRecord.__table__.indexes:
+        index.create(conn, checkfirst=True)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def init_db(attempts: int = 3) -> None:
+    # Workers started together can race between the existence check and CREATE;
+    # the losers retry, and the re-check then skips what the winner created
+    for attempt in range(1, attempts + 1):
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(create_tables)
+            return
+        except DBAPIError:
+            if attempt == attempts:
+                raise
+            logger.info("Schema creation raced another worker, retrying")
+
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 # ---------- Pydantic Models ----------
@@ -94,13 +185,16 @@ class PlanRequest(BaseModel):
     @classmethod
     def validate_depart_time(cls, v: str):
         try:
-            datetime.fromisoformat(v.replace("Z", "+00:00"))
+            # Python 3.11+ parses the trailing "Z" natively
+            datetime.fromisoformat(v)
         except Exception:
             raise ValueError("depart_time must be ISO 8601 format")
         return v
 
 
-class Poi(BaseModel):
+# ---------- Gemini Response Models ----------
+# msgspec decodes and validates the Gemini JSON in a single pass
+class Poi(msgspec.Struct):
     name: str
     category: str
     address: Optional[str] = None
@@ -110,14 +204,14 @@ class Poi(BaseModel):
     transport: Optional[str] = None
 
 
-class Meal(BaseModel):
+class Meal(msgspec.Struct):
     name: str
     type: str  # breakfast / lunch / dinner / snack
     reservation_needed: Optional[bool] = None
     notes: Optional[str] = None
 
 
-class DayPlan(BaseModel):
+class DayPlan(msgspec.Struct):
     date: str
     summary: str
     schedule: List[str]
@@ -127,7 +221,7 @@ class DayPlan(BaseModel):
     tips: Optional[str] = None
 
 
-class PlanResponse(BaseModel):
+class PlanResponse(msgspec.Struct):
     destination: str
     start_date: str
     end_date: str
@@ -139,33 +233,50 @@ class PlanResponse(BaseModel):
     disclaimers: Optional[str] = None
 
 
+# OpenAPI schema for PlanResponse, merged into the generated docs below
+(PLAN_RESPONSE_SCHEMA,), PLAN_SCHEMA_COMPONENTS = msgspec.json.schema_components(
+    (PlanResponse,), ref_template="#/components/schemas/{name}"
+)
+
+
+def openapi():
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        schema["components"]["schemas"].update(PLAN_SCHEMA_COMPONENTS)
+    return app.openapi_schema
+
+
+app.openapi = openapi
+
+
 # ---------- Prompt Builder ----------
-def build_prompt(req: PlanRequest) -> str:
-    return f"""
+# Parsed once at import; each request only substitutes its own values
+PROMPT_TEMPLATE = Template(
+    """
 You are a professional travel planner.
-Generate a detailed {req.language} travel itinerary in pure JSON format only — no explanations or extra text.
+Generate a detailed $language travel itinerary in pure JSON format only — no explanations or extra text.
 
 Input details:
-- Origin: {req.origin}
-- Destination: {req.destination}
-- Departure: {req.depart_time}
-- Trip length: {req.trip_length_days} days
-- Preferences: {req.preferences.model_dump() if req.preferences else "not specified"}
+- Origin: $origin
+- Destination: $destination
+- Departure: $depart_time
+- Trip length: $trip_length_days days
+- Preferences: $preferences
 
 Output structure:
-{{
+{
   "destination": "string",
   "start_date": "YYYY-MM-DD",
   "end_date": "YYYY-MM-DD",
-  "total_days": {req.trip_length_days},
+  "total_days": $trip_length_days,
   "overview": "string",
   "daily": [
-    {{
+    {
       "date": "YYYY-MM-DD",
       "summary": "string",
       "schedule": ["09:00 Depart", "11:00 Arrive downtown"],
       "pois": [
-        {{
+        {
           "name": "string",
           "category": "landmark/museum/nature/shopping/other",
           "address": "string",
@@ -173,47 +284,56 @@ Output structure:
           "notes": "string",
           "cost_estimate": "string",
           "transport": "string"
-        }}
+        }
       ],
       "meals": [
-        {{
+        {
           "name": "string",
           "type": "breakfast/lunch/dinner/snack",
           "reservation_needed": true,
           "notes": "string"
-        }}
+        }
       ],
       "logistics": "string",
       "tips": "string"
-    }}
+    }
   ],
   "packing_list": ["Passport", "Universal adapter", "..."],
   "budget_summary": "string",
   "disclaimers": "string"
-}}
+}
 
 Rules:
 1. Return ONLY valid JSON.
 2. Do not add comments, markdown, or backticks.
 3. Ensure every string is properly closed and escaped.
 """
+)
+
+
+def build_prompt(req: PlanRequest, preferences: Optional[str]) -> str:
+    return PROMPT_TEMPLATE.substitute(
+        language=req.language,
+        origin=req.origin,
+        destination=req.destination,
+        depart_time=req.depart_time,
+        trip_length_days=req.trip_length_days,
+        preferences=preferences or "not specified",
+    )
 
 
 # ---------- Gemini Call ----------
-def call_gemini(req: PlanRequest) -> PlanResponse:
-    GEMINI_MODEL = "gemini-2.0-flash-lite"
-
-    model = genai.GenerativeModel(GEMINI_MODEL)
-    config = {
-        "temperature": 0.6,
-        "top_p": 0.9,
-        "max_output_tokens": 4096,
-        "response_mime_type": "application/json",
-    }
-    prompt = build_prompt(req)
+async def call_gemini(req: PlanRequest, preferences: Optional[str]) -> str:
+    prompt = build_prompt(req, preferences)
 
     try:
-        resp = model.generate_content(prompt, generation_config=config)
+        resp = await GEMINI_MODEL.generate_content_async(
+            prompt, generation_config=GEN_CONFIG
+        )
+        # Output that stopped on the token limit can't be complete JSON; check
+        # before .text, which raises when the reply carries no parts
+        if any(c.finish_reason == MAX_TOKENS for c in resp.candidates):
+            raise ValueError("Incomplete JSON returned: response was cut off")
         raw = resp.text.strip()
 
         # Try to recover valid JSON if Gemini adds extra text
@@ -226,45 +346,163 @@ def call_gemini(req: PlanRequest) -> PlanResponse:
             if idx != -1:
                 raw = raw[: idx + 1]
 
+        # Text that already matches the schema is stored and returned as-is;
+        # otherwise coerce loosely typed values (e.g. "2" for a number) and
+        # re-encode, so clients never see values the schema doesn't allow
         try:
-            data = json.loads(raw)
-        except json.JSONDecodeError as e:
+            msgspec.json.decode(raw, type=PlanResponse)
+        except msgspec.ValidationError:
+            try:
+                data = msgspec.json.decode(raw, type=PlanResponse, strict=False)
+            except msgspec.DecodeError as e:
+                raise ValueError(f"Invalid JSON returned: {e}")
+            raw = msgspec.json.encode(data).decode()
+        except msgspec.DecodeError as e:
             raise ValueError(f"Invalid JSON returned: {e}")
 
-        return PlanResponse(**data)
+        return raw
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI generation failed: {e}")
 
 
+# ---------- Plan Cache ----------
+# Identical requests reuse the last generated plan instead of calling Gemini again.
+PLAN_CACHE_TTL = int(os.getenv("PLAN_CACHE_TTL", "3600"))
+plan_cache: TTLCache = TTLCache(maxsize=1024, ttl=PLAN_CACHE_TTL)
+plan_locks: Dict[str, asyncio.Lock] = {}
+plan_lock_users: Dict[str, int] = {}
+
+
+def plan_cache_key(req: PlanRequest, preferences: Optional[str]) -> str:
+    # Reuses the preferences JSON from /plan instead of dumping the request again
+    fields = (
+        req.origin.strip().casefold(),
+        req.destination.strip().casefold(),
+        req.depart_time,
+        str(req.trip_length_days),
+        req.language,
+        preferences or "",
+    )
+    return hashlib.blake2b("\x1f".join(fields).encode(), digest_size=16).hexdigest()
+
+
+async def get_plan(req: PlanRequest, preferences: Optional[str]) -> str:
+    key = plan_cache_key(req, preferences)
+    data = plan_cache.get(key)
+    if data is not None:
+        return data
+
+    # Concurrent identical requests wait for the first one instead of all hitting Gemini
+    # The lock is dropped only once no request holds or waits on it
+    lock = plan_locks.setdefault(key, asyncio.Lock())
+    plan_lock_users[key] = plan_lock_users.get(key, 0) + 1
+    try:
+        async with lock:
+            data = plan_cache.get(key)
+            if data is None:
+                data = await call_gemini(req, preferences)
+                plan_cache[key] = data
+    finally:
+        plan_lock_users[key] -= 1
+        if not plan_lock_users[key]:
+            del plan_lock_users[key]
+            del plan_locks[key]
+    return data
+
+
+# ---------- History ----------
+async def save_record(
+    req: PlanRequest, preferences: Optional[str], raw: str
+) -> None:
+    async with SessionLocal() as db:
+        db.add(
+            TravelRecord(
+                origin=req.origin,
+                destination=req.destination,
+                depart_time=req.depart_time,
+                trip_length_days=req.trip_length_days,
+                preferences=preferences or "{}",
+                response=raw,
+            )
+        )
+        await db.commit()
+
+
+def history_cache_key(record_id: int) -> str:
+    return f"history:{record_id}"
+
+
+# Redis is only a cache: on any Redis error the routes fall back to the DB.
+# A GET that read the row just before a DELETE committed can still cache the
+# deleted record after it was evicted; the TTL bounds that stale window.
+async def history_cache_get(record_id: int) -> Optional[bytes]:
+    if redis_client is None:
+        return None
+    try:
+        return await redis_client.get(history_cache_key(record_id))
+    except RedisError:
+        logger.warning("Redis read failed for record %s", record_id, exc_info=True)
+        return None
+
+
+async def history_cache_set(record_id: int, response: str) -> None:
+    if redis_client is None:
+        return
+    try:
+        await redis_client.set(
+            history_cache_key(record_id), response, ex=HISTORY_CACHE_TTL, nx=True
+        )
+    except RedisError:
+        logger.warning("Redis write failed for record %s", record_id, exc_info=True)
+
+
+async def history_cache_delete(record_id: int) -> None:
+    if redis_client is None:
+        return
+    try:
+        await redis_client.delete(history_cache_key(record_id))
+    except RedisError:
+        logger.error("Redis evict failed for record %s", record_id, exc_info=True)
+
+
 # ---------- Routes ----------
 @app.get("/")
 def root():
     return {"ok": True, "service": "AI Travel Planner API"}
 
 
-@app.post("/plan", response_model=PlanResponse)
-def plan(req: PlanRequest, db: DBSession = Depends(get_db)):
-    data = call_gemini(req)
-    record = TravelRecord(
-        origin=req.origin,
-        destination=req.destination,
-        depart_time=req.depart_time,
-        trip_length_days=req.trip_length_days,
-        preferences=json.dumps(req.preferences.model_dump() if req.preferences else {}),
-        response=json.dumps(data if isinstance(data, dict) else data.dict()),
+@app.post(
+    "/plan",
+    responses={200: {"content": {"application/json": {"schema": PLAN_RESPONSE_SCHEMA}}}},
+)
+async def plan(req: PlanRequest):
+    # Serialized once and shared by the prompt and the history record
+    preferences = req.preferences.model_dump_json() if req.preferences else None
+    raw = await get_plan(req, preferences)
+    # History is saved after the response is sent, off the request's critical path
+    return Response(
+        content=raw,
+        media_type="application/json",
+        background=BackgroundTask(save_record, req, preferences, raw),
     )
 
-    db.add(record)
-    db.commit()
-    db.refresh(record)
-    return data
-
 
 @app.get("/history")
-def get_history(db: DBSession = Depends(get_db)):
-    records = (
-        db.query(TravelRecord).order_by(TravelRecord.created_at.desc()).limit(20).all()
+async def get_history(db: AsyncSession = Depends(get_db)):
+    # Only the listed columns; the large response/preferences blobs stay in the DB
+    result = await db.execute(
+        select(
+            TravelRecord.id,
+            TravelRecord.origin,
+            TravelRecord.destination,
+            TravelRecord.depart_time,
+            TravelRecord.trip_length_days,
+            TravelRecord.created_at,
+        )
+        .order_by(TravelRecord.created_at.desc())
+        .limit(20)
     )
+    records = result.all()
     return [
         {
             "id": r.id,
@@ -279,23 +517,24 @@ def get_history(db: DBSession = Depends(get_db)):
 
 
 @app.get("/history/{record_id}")
-def get_record_detail(record_id: int, db: DBSession = Depends(get_db)):
-    r = db.query(TravelRecord).filter(TravelRecord.id == record_id).first()
+async def get_record_detail(record_id: int, db: AsyncSession = Depends(get_db)):
+    cached = await history_cache_get(record_id)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+
+    r = await db.get(TravelRecord, record_id)
     if not r:
         raise HTTPException(status_code=404, detail="Record not found")
-    return json.loads(r.response)
-
-
-from fastapi.responses import JSONResponse
+    await history_cache_set(record_id, r.response)
+    return Response(content=r.response, media_type="application/json")
 
 
 @app.delete("/history/{record_id}")
-def delete_record(record_id: int, db: DBSession = Depends(get_db)):
-    record = db.query(TravelRecord).filter(TravelRecord.id == record_id).first()
+async def delete_record(record_id: int, db: AsyncSession = Depends(get_db)):
+    record = await db.get(TravelRecord, record_id)
     if not record:
         raise HTTPException(status_code=404, detail="Record not found")
-    db.delete(record)
-    db.commit()
-    return JSONResponse(
-        content={"message": "Record deleted successfully", "id": record_id}
-    )
+    await db.delete(record)
+    await db.commit()
+    await history_cache_delete(record_id)
+    return {"message": "Record deleted successfully", "id": record_id}
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# main.py refuses to import without a key; tests never reach the real API
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.pop("REDIS_URL", None)
+# Route tests run against a throwaway SQLite file
+TEST_DB = os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["MYSQL_URL"] = f"sqlite+aiosqlite:///{TEST_DB}"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,374 @@
+import asyncio
+import json
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from redis.exceptions import RedisError
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+import main
+
+PLAN = {
+    "destination": "Tokyo",
+    "start_date": "2025-01-01",
+    "end_date": "2025-01-02",
+    "total_days": 2,
+    "overview": "Two days in Tokyo",
+    "daily": [
+        {
+            "date": "2025-01-01",
+            "summary": "Arrive",
+            "schedule": ["09:00 Depart"],
+            "pois": [{"name": "Senso-ji", "category": "landmark"}],
+            "meals": [{"name": "Ramen", "type": "dinner"}],
+        }
+    ],
+    "packing_list": ["Passport"],
+}
+BODY = json.dumps(PLAN)
+STOP = 1  # FinishReason.STOP
+
+
+def make_req(**kwargs):
+    fields = {
+        "origin": "New York",
+        "destination": "Tokyo",
+        "depart_time": "2025-01-01T00:00:00.000Z",
+        "trip_length_days": 2,
+    }
+    return main.PlanRequest(**{**fields, **kwargs})
+
+
+class FakeResponse:
+    """Mimics a Gemini response, including `.text` raising without parts."""
+
+    def __init__(self, text, finish_reason):
+        parts = [SimpleNamespace(text=text)] if text else []
+        content = SimpleNamespace(parts=parts)
+        candidate = SimpleNamespace(finish_reason=finish_reason, content=content)
+        self.candidates = [candidate]
+        self.parts = parts
+
+    @property
+    def text(self):
+        if not self.parts:
+            raise ValueError("`response.text` requires a valid `Part`")
+        return self.parts[0].text
+
+
+class FakeModel:
+    """Stands in for GEMINI_MODEL, replying with the given text."""
+
+    def __init__(self, text, finish_reason=STOP):
+        self.text = text
+        self.finish_reason = finish_reason
+        self.calls = 0
+
+    async def generate_content_async(self, prompt, generation_config):
+        self.calls += 1
+        return FakeResponse(self.text, self.finish_reason)
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    def install(text, finish_reason=STOP):
+        model = FakeModel(text, finish_reason)
+        monkeypatch.setattr(main, "GEMINI_MODEL", model)
+        return model
+
+    return install
+
+
+def test_call_gemini_returns_complete_reply_unchanged(gemini):
+    gemini(BODY)
+    assert asyncio.run(main.call_gemini(make_req(), None)) == BODY
+
+
+def test_call_gemini_strips_fences_around_json(gemini):
+    gemini("```json\n" + BODY + "\n```")
+    assert asyncio.run(main.call_gemini(make_req(), None)) == BODY
+
+
+def test_call_gemini_rejects_truncated_reply(gemini):
+    gemini(BODY[:-20], finish_reason=main.MAX_TOKENS)
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(main.call_gemini(make_req(), None))
+    assert "cut off" in exc.value.detail
+
+
+def test_call_gemini_reports_truncation_when_reply_has_no_parts(gemini):
+    gemini("", finish_reason=main.MAX_TOKENS)
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(main.call_gemini(make_req(), None))
+    assert "cut off" in exc.value.detail
+
+
+def test_call_gemini_rejects_invalid_plan(gemini):
+    plan = dict(PLAN, daily=[{"date": "2025-01-01"}])
+    gemini(json.dumps(plan))
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(main.call_gemini(make_req(), None))
+    assert "Invalid JSON returned" in exc.value.detail
+
+
+def test_build_prompt_states_language_and_trip_length():
+    prompt = main.build_prompt(make_req(language="fr", trip_length_days=3), None)
+    assert "Generate a detailed fr travel itinerary" in prompt
+    assert '"total_days": 3,' in prompt
+    assert "- Preferences: not specified" in prompt
+
+
+def test_call_gemini_reencodes_coerced_values(gemini):
+    gemini(BODY.replace('"total_days": 2', '"total_days": "2"'))
+    data = json.loads(asyncio.run(main.call_gemini(make_req(), None)))
+    assert data["total_days"] == 2
+
+
+def test_get_plan_serves_identical_requests_from_cache(gemini, monkeypatch):
+    monkeypatch.setattr(main, "plan_cache", main.TTLCache(maxsize=8, ttl=60))
+    model = gemini(BODY)
+
+    async def run():
+        await main.get_plan(make_req(), None)
+        await main.get_plan(make_req(destination=" tokyo "), None)
+
+    asyncio.run(run())
+    assert model.calls == 1
+
+
+def test_plan_cache_key_uses_given_preferences(monkeypatch):
+    req = make_req(preferences={"pace": "relaxed"})
+    # The key must not serialize the request (and its preferences) a second time
+    monkeypatch.setattr(main.PlanRequest, "model_dump_json", pytest.fail)
+    relaxed = main.plan_cache_key(req, '{"pace":"relaxed"}')
+    assert relaxed != main.plan_cache_key(req, '{"pace":"tight"}')
+    assert relaxed != main.plan_cache_key(make_req(language="fr"), '{"pace":"relaxed"}')
+
+
+def test_get_plan_waiters_retry_once_after_failure(monkeypatch):
+    monkeypatch.setattr(main, "plan_cache", main.TTLCache(maxsize=8, ttl=60))
+    calls = []
+
+    async def fake_call_gemini(req, preferences):
+        calls.append(req)
+        await asyncio.sleep(0.05)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        return BODY
+
+    monkeypatch.setattr(main, "call_gemini", fake_call_gemini)
+
+    async def one(delay):
+        await asyncio.sleep(delay)
+        try:
+            return await main.get_plan(make_req(), None)
+        except RuntimeError:
+            return None
+
+    async def run():
+        # The last request arrives after the failure, while a waiter retries
+        return await asyncio.gather(one(0), one(0.01), one(0.06))
+
+    assert asyncio.run(run()) == [None, BODY, BODY]
+    assert len(calls) == 2
+    assert main.plan_locks == {} and main.plan_lock_users == {}
+
+
+class BrokenRedis:
+    async def get(self, key):
+        raise RedisError("down")
+
+    async def set(self, key, value, **kwargs):
+        raise RedisError("down")
+
+    async def delete(self, key):
+        raise RedisError("down")
+
+    async def aclose(self):
+        pass
+
+
+class FakeDB:
+    def __init__(self, record):
+        self.record = record
+
+    async def get(self, model, record_id):
+        return self.record
+
+
+def test_history_detail_falls_back_to_db_when_redis_fails(monkeypatch):
+    monkeypatch.setattr(main, "redis_client", BrokenRedis())
+    db = FakeDB(SimpleNamespace(response=BODY))
+
+    resp = asyncio.run(main.get_record_detail(1, db))
+    assert resp.status_code == 200
+    assert resp.body == BODY.encode()
+
+
+@pytest.mark.parametrize(
+    "url, expected",
+    [
+        ("sqlite:///./ai_travel.db", "sqlite+aiosqlite:///./ai_travel.db"),
+        ("mysql://u:p@db/travel", "mysql+aiomysql://u:p@db/travel"),
+        ("mysql+pymysql://u:p@db:3306/travel", "mysql+aiomysql://u:p@db:3306/travel"),
+        ("mysql+aiomysql://u:p@db/travel", "mysql+aiomysql://u:p@db/travel"),
+    ],
+)
+def test_async_db_url_maps_sync_drivers(url, expected):
+    assert main.async_db_url(url).render_as_string(hide_password=False) == expected
+
+
+def db_execute(sql):
+    conn = sqlite3.connect(main.engine.url.database)
+    try:
+        rows = conn.execute(sql).fetchall()
+        conn.commit()
+        return rows
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def client():
+    with TestClient(main.app) as c:
+        yield c
+    db_execute("DELETE FROM travel_records")
+
+
+def test_startup_adds_indexes_missing_from_existing_table(client):
+    db_execute("DROP INDEX ix_travel_records_created_at")
+    with TestClient(main.app):
+        pass
+    names = {row[1] for row in db_execute("PRAGMA index_list(travel_records)")}
+    assert "ix_travel_records_created_at" in names
+
+
+def insert_record(destination, created_at):
+    db_execute(
+        "INSERT INTO travel_records (origin, destination, depart_time, "
+        "trip_length_days, preferences, response, created_at) VALUES "
+        f"('New York', '{destination}', '2025-01-01', 2, '{{}}', '{BODY}', "
+        f"'{created_at}')"
+    )
+
+
+def test_history_lists_newest_first_without_loading_blobs(client):
+    insert_record("Kyoto", "2025-01-01 00:00:00.000000")
+    insert_record("Osaka", "2025-01-02 00:00:00.000000")
+    statements = []
+
+    def record_sql(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(main.engine.sync_engine, "before_cursor_execute", record_sql)
+    try:
+        resp = client.get("/history")
+    finally:
+        event.remove(main.engine.sync_engine, "before_cursor_execute", record_sql)
+
+    assert [r["destination"] for r in resp.json()] == ["Osaka", "Kyoto"]
+    (query,) = [sql for sql in statements if "FROM travel_records" in sql]
+    assert "response" not in query and "preferences" not in query
+
+
+def test_plan_saves_history_record_in_background(client, gemini, monkeypatch):
+    monkeypatch.setattr(main, "plan_cache", main.TTLCache(maxsize=8, ttl=60))
+    gemini(BODY)
+
+    resp = client.post(
+        "/plan",
+        json={
+            "origin": "New York",
+            "destination": "Tokyo",
+            "depart_time": "2025-01-01T00:00:00.000Z",
+            "trip_length_days": 2,
+            "preferences": {"pace": "relaxed"},
+        },
+    )
+
+    assert resp.status_code == 200
+    assert resp.json() == PLAN
+    rows = db_execute("SELECT destination, preferences, response FROM travel_records")
+    assert len(rows) == 1
+    destination, preferences, response = rows[0]
+    assert destination == "Tokyo"
+    assert json.loads(preferences)["pace"] == "relaxed"
+    assert response == BODY
+
+
+def test_plan_defers_history_write_to_background_task(gemini, monkeypatch):
+    monkeypatch.setattr(main, "plan_cache", main.TTLCache(maxsize=8, ttl=60))
+    gemini(BODY)
+
+    resp = asyncio.run(main.plan(make_req()))
+
+    assert resp.body == BODY.encode()
+    assert resp.background.func is main.save_record
+
+
+class MemoryRedis:
+    """In-memory stand-in for the few Redis calls the history cache makes."""
+
+    def __init__(self):
+        self.store = {}
+        self.expiry = {}
+
+    async def get(self, key):
+        return self.store.get(key)
+
+    async def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.store:
+            return None
+        self.store[key] = value.encode() if isinstance(value, str) else value
+        self.expiry[key] = ex
+        return True
+
+    async def delete(self, key):
+        self.store.pop(key, None)
+
+    async def aclose(self):
+        pass
+
+
+def test_history_detail_is_cached_and_evicted_on_delete(monkeypatch, client):
+    redis = MemoryRedis()
+    monkeypatch.setattr(main, "redis_client", redis)
+    insert_record("Tokyo", "2025-01-01 00:00:00.000000")
+    record_id = client.get("/history").json()[0]["id"]
+    key = main.history_cache_key(record_id)
+
+    assert client.get(f"/history/{record_id}").json() == PLAN
+    assert redis.store[key] == BODY.encode()
+    assert redis.expiry[key] == main.HISTORY_CACHE_TTL
+
+    assert client.delete(f"/history/{record_id}").status_code == 200
+    assert key not in redis.store
+    assert client.get(f"/history/{record_id}").status_code == 404
+
+
+def test_history_cache_errors_do_not_break_delete(monkeypatch, client):
+    monkeypatch.setattr(main, "redis_client", BrokenRedis())
+    insert_record("Tokyo", "2025-01-01 00:00:00.000000")
+    record_id = client.get("/history").json()[0]["id"]
+
+    assert client.delete(f"/history/{record_id}").status_code == 200
+    assert db_execute("SELECT id FROM travel_records") == []
+
+
+def test_init_db_retries_when_another_worker_created_the_schema(monkeypatch):
+    real_create_tables = main.create_tables
+    calls = []
+
+    def racing_create_tables(conn):
+        calls.append(conn)
+        if len(calls) == 1:
+            raise OperationalError("CREATE TABLE", {}, Exception("already exists"))
+        real_create_tables(conn)
+
+    monkeypatch.setattr(main, "create_tables", racing_create_tables)
+    asyncio.run(main.init_db())
+    assert len(calls) == 2